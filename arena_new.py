@@ -1,10 +1,15 @@
 # Made by Michael Hodis and Jonah Shatkin
 # This program uses simple cards from the first few arenas and uses graphs (trees) # to find the optimal cards to play based on the "Threat Level" heuristic
 
-import json, math, tkinter as tk
+import json, math, copy, sys, zlib, tkinter as tk
+from scheduler import FrameScheduler
+from history import History
+
+from influence import InfluenceMap
 
 try:
     from predictor import Predictor
+    from worker import RecommendationWorker
     HAS_PREDICTOR = True
 except: HAS_PREDICTOR = False
 
@@ -14,6 +19,8 @@ with open('clash_royale_cards.json', 'r') as f:
 card_data, card_names = data['CARDDATA'], data['METADATA']['card_names']
 
 ARENA_W, ARENA_H, CELL = 18, 32, 20
+# The simulation runs in whole ticks, match_time is worked out from the tick count
+TICK_RATE = 60
 LEFT_BRIDGE, RIGHT_BRIDGE = 3.5, 14.5
 
 # Most troops are just one but these swarm troops are
@@ -26,6 +33,11 @@ TROOP_COUNTS = {
     'spe': 3
 }
 
+# Where each troop of a card spawns, relative to the spot it was played on
+def spawn_offsets(key):
+    count = TROOP_COUNTS.get(key, 1)
+    return [(0,0)] if count==1 else [(-0.5,0),(0.5,0)] if count==2 else [(0,0),(-0.5,0.5),(0.5,0.5)]
+
 # In order to simplify the placing process, we added shortcuts for the names of each location cards are frequently placed at. 
 # This means that there's less controllability when playing but it is also easier to type each command out
 POSITIONS = {
@@ -109,7 +121,24 @@ class Arena:
             'red':  {'left':Tower('left',3.5,7.5,3052,109,3),  'right':Tower('right',14.5,7.5,3052,109,3),  'king':Tower('king',9,3,5000,122,4)}
         }
         self.elixir = {'blue':5.0, 'red':5.0}
-        self.max_elixir, self.match_time, self.match_duration, self.running = 10.0, 0.0, 180.0, False
+        self.tick = 0
+        self.max_elixir, self.match_duration, self.running = 10.0, 180.0, False
+        # Every unit and spell gets a number so two runs of the same match can be lined up
+        self.next_uid = 0
+        # Copies used for simulating ahead turn this off so they don't spam the console
+        self.verbose = True
+        self.influence = InfluenceMap(ARENA_W, ARENA_H)
+        self.influence.update(self)
+
+    # Time used to be added up 1/60 at a time, which slowly drifts. Counting whole
+    # ticks keeps two runs of the same match exactly in step.
+    @property
+    def match_time(self):
+        return self.tick / TICK_RATE
+
+    @match_time.setter
+    def match_time(self, t):
+        self.tick = round(t * TICK_RATE)
 
     # Update elixir based on how much time is left in the match.
     # Single elixir - 1 elixir every 2.8 seconds
@@ -136,26 +165,92 @@ class Arena:
     # screen will use this method to add troops
     def add_unit(self, key, pos, team):
         if key not in card_data or team not in POSITIONS or pos not in POSITIONS[team]:
-            print(f"Invalid: {key} {pos} {team}"); return False
+            if self.verbose: print(f"Invalid: {key} {pos} {team}")
+            return False
         cost = card_data[key]['elixir']
         if isinstance(cost, str): cost = 0
         if self.elixir[team] < cost:
-            print(f"Need {cost} elixir, have {self.elixir[team]:.1f}"); return False
+            if self.verbose: print(f"Need {cost} elixir, have {self.elixir[team]:.1f}")
+            return False
         
         self.elixir[team] -= cost
         x, y = POSITIONS[team][pos]
         
         if card_data[key]['spell']:
-            self.spells.append(Spell(key, x, y, team))
+            s = Spell(key, x, y, team)
+            s.uid, self.next_uid = self.next_uid, self.next_uid + 1
+            self.spells.append(s)
         else:
-            count = TROOP_COUNTS.get(key, 1)
-            offsets = [(0,0)] if count==1 else [(-0.5,0),(0.5,0)] if count==2 else [(0,0),(-0.5,0.5),(0.5,0.5)]
-            for dx,dy in offsets:
-                self.units.append(Unit(key, x+dx, y+dy, team, spawn_pos=pos))
+            for dx,dy in spawn_offsets(key):
+                u = Unit(key, x+dx, y+dy, team, spawn_pos=pos)
+                u.uid, self.next_uid = self.next_uid, self.next_uid + 1
+                self.units.append(u)
         
-        print(f"Added {card_names[key]} ({team}) at {pos} [-{cost}]")
+        # Stamp the new troops right away so the predictor sees them before the next tick
+        self.influence.update(self)
+        if self.verbose: print(f"Added {card_names[key]} ({team}) at {pos} [-{cost}]")
         return True
 
+    # A full independent copy of the match that can be simulated without touching this one
+    def snapshot(self):
+        a = copy.deepcopy(self)
+        a.verbose = False
+        a.influence.dirty = set()
+        return a
+
+    # Everything that matters about the match right now as (name, values) pairs.
+    # Used to compare two engines running the same match, so any faster engine
+    # just has to be able to produce the same list.
+    def state(self):
+        rows = [('arena', (self.tick, self.elixir['blue'], self.elixir['red']))]
+        for team, towers in self.towers.items():
+            for t in towers.values():
+                rows.append((f"tower.{team}.{t.name}", (t.health, t.attack_cooldown)))
+        for u in self.units:
+            rows.append((f"unit{u.uid}.{u.team}.{u.key}", (u.x, u.y, u.health, u.attack_cooldown)))
+        for s in self.spells:
+            rows.append((f"spell{s.uid}.{s.team}.{s.key}", (s.delay,)))
+        return rows
+
+    # A number that changes if anything in state() changes by more than tolerance.
+    # Values are rounded to the tolerance first so tiny float differences don't count.
+    # A tolerance of 0 means exact, so the values go in as they are.
+    def checksum(self, tolerance=1e-6):
+        parts = []
+        for name, values in self.state():
+            parts.append(name)
+            for v in values: parts.append(repr(v) if tolerance == 0 else str(round(v / tolerance)))
+        return zlib.crc32(' '.join(parts).encode())
+
+    # Plain tuples of everything needed to put the match back the way it is now.
+    # Much smaller than snapshot(), used by the rewind history.
+    def compact(self):
+        return {
+            'tick': self.tick, 'elixir': (self.elixir['blue'], self.elixir['red']), 'next_uid': self.next_uid,
+            'towers': {(team, t.name): (t.health, t.attack_cooldown) for team, towers in self.towers.items() for t in towers.values()},
+            'units': {u.uid: (u.key, u.team, u.spawn_pos, u.x, u.y, u.health, u.attack_cooldown) for u in self.units},
+            'spells': {s.uid: (s.key, s.team, s.x, s.y, s.delay) for s in self.spells},
+        }
+
+    # Puts the match back to a state from compact()
+    def load_compact(self, state):
+        self.tick, self.next_uid = state['tick'], state['next_uid']
+        self.elixir['blue'], self.elixir['red'] = state['elixir']
+        for (team, name), (health, cooldown) in state['towers'].items():
+            t = self.towers[team][name]
+            t.health, t.attack_cooldown = health, cooldown
+        self.units = []
+        for uid, (key, team, spawn_pos, x, y, health, cooldown) in state['units'].items():
+            u = Unit(key, x, y, team, spawn_pos)
+            u.uid, u.health, u.attack_cooldown = uid, health, cooldown
+            self.units.append(u)
+        self.spells = []
+        for uid, (key, team, x, y, delay) in state['spells'].items():
+            s = Spell(key, x, y, team)
+            s.uid, s.delay = uid, delay
+            self.spells.append(s)
+        self.influence.rebuild(self)
+
     # We want to path to the bridge first, and then go to
     # the tower, just like what we found happens ingame.
     def get_bridge_x(self, unit):
@@ -212,7 +307,7 @@ class Arena:
 
     # Uses delta time like we explained in class to update the time and elixir
     def update(self):
-        self.match_time += 1/60
+        self.tick += 1
         rate = self.get_elixir_rate()
         for t in ['blue','red']: self.elixir[t] = min(self.max_elixir, self.elixir[t] + rate/60)
 
@@ -270,10 +365,11 @@ class Arena:
                 if t.attack_cooldown > 0: t.attack_cooldown -= 1
 
         self.units = [u for u in self.units if u.health > 0]
+        self.influence.update(self)
 
 # Draw everything using TKinter 
 class GUI:
-    def __init__(self, arena):
+    def __init__(self, arena, evaluator=None):
         self.arena = arena
         self.root = tk.Tk()
         self.root.title("Arena")
@@ -283,10 +379,17 @@ class GUI:
         
         self.canvas = tk.Canvas(main, width=ARENA_W*CELL, height=ARENA_H*CELL, bg='#2a2a2a')
         self.canvas.pack(side=tk.LEFT)
+        self.heat_cells = {}
+        self.scheduler = FrameScheduler(TICK_RATE)
+        self.history = History()
+        self.draw_background()
         
         self.predictor = None
         if HAS_PREDICTOR:
-            self.predictor = Predictor(arena, 'blue')
+            self.predictor = Predictor(arena, 'blue', evaluator)
+            # The predictor runs on its own thread and we only ever read its latest answer
+            self.worker, self.last_submit = RecommendationWorker(), 0
+            self.worker.start()
             panel = tk.Frame(main, width=180, bg='#1a1a2e')
             panel.pack(side=tk.RIGHT, fill=tk.Y)
             panel.pack_propagate(False)
@@ -308,21 +411,29 @@ class GUI:
         # Lambda replaced with a helper method
         tk.Button(ctrl, text="Run", command=self.run_command).pack(side=tk.LEFT, padx=5, pady=5)
         
-        print("Commands: hand/next/add/start/quit")
+        print("Commands: hand/deck/next/add/start/heat/rewind/resume/quit")
 
     # Helper function for the 'Run' button command
     def run_command(self):
         self.cmd(None)
 
-    # Refresh the predictions and suggestions
+    # Refresh the predictions and suggestions. The worker gets a new copy of the arena
+    # whenever something important changed, and otherwise every 3 seconds of match time
+    # like the predictor's own refresh. Then we show whatever its best answer is so far.
     def update_predictor(self):
         if not self.predictor: return
         self.hand_label.config(text=self.predictor.get_hand_display())
-        r = self.predictor.get_recommendation()
+        force = self.arena.match_time - self.last_submit >= 3
+        if self.worker.submit(self.arena, self.predictor, force) or force:
+            self.last_submit = self.arena.match_time
+        r = self.worker.latest
         if r:
             txt = f"Play: {r['card_name']}\nAt: {r['position']}\nCost: {r['elixir_cost']}\n\n{r['reason']}" if r['card'] else r['reason']
             self.rec_label.config(text=txt)
-            self.threat_label.config(text=f"Threat: {r['threat_level']:.0f}%")
+            txt = f"Threat: {r['threat_level']:.0f}%"
+            ev = self.predictor.evaluator
+            if ev and ev.last_batch: txt += f"\nEval: {ev.last_batch} in {ev.last_latency*1000:.1f}ms"
+            self.threat_label.config(text=txt)
 
     # List of all of the commands you can use
     # Each one is based on the first word typed
@@ -332,9 +443,13 @@ class GUI:
         if not txt: return
         c = txt.split()
         
-        if c[0] == 'quit': self.root.quit()
+        if c[0] == 'quit':
+            if self.predictor: self.worker.stop()
+            self.root.quit()
         elif c[0] == 'hand' and len(c) >= 5:
             if self.predictor: self.predictor.set_hand(c[1:5]); self.update_predictor()
+        elif c[0] == 'deck' and len(c) >= 9:
+            if self.predictor: self.predictor.set_deck(c[1:9]); self.update_predictor()
         elif c[0] == 'next' and len(c) >= 2:
             if self.predictor: self.predictor.set_next(c[1]); self.update_predictor()
         elif c[0] == 'add' and len(c) == 4:
@@ -342,46 +457,124 @@ class GUI:
             if self.arena.add_unit(card_key, c[2], team):
                 # BUG FIX: Only update the predictor's hand if the card was played by the predictor's team ('blue')
                 if self.predictor and team == 'blue': 
-                    self.predictor.on_card_played(card_key)
+                    self.predictor.play_card(card_key)
                     self.update_predictor()
+                # Red plays are how the predictor learns the opponent's cycle
+                elif self.predictor and team == 'red':
+                    self.predictor.on_enemy_played(card_key)
+        elif c[0] == 'heat': self.toggle_heatmap()
+        elif c[0] == 'rewind' and len(c) == 2:
+            self.rewind(c[1])
+        elif c[0] == 'resume':
+            self.arena.running = True; print(f"Resumed at {self.arena.get_time_string()}"); self.update_predictor()
         elif c[0] == 'start':
             self.arena.running = True; print("Started!"); self.update_predictor()
         else: print(f"Unknown: {txt}")
 
-    # Create the entire arena using basic TKinter functions and some trial and error
-    def draw(self):
+    # Pauses the match and goes back the given number of seconds (or as far as the
+    # history goes). Use 'resume' to carry on playing from there.
+    # The card cycles go back too, and the worker starts over on the rewound state.
+    def rewind(self, text):
+        try: seconds = float(text)
+        except ValueError: seconds = math.nan
+        if not math.isfinite(seconds) or seconds < 0:
+            print(f"Unknown: rewind {text}"); return
+        if self.history.oldest_tick() is None:
+            print("Nothing to rewind"); return
+        self.arena.running = False
+        state = self.history.restore(self.arena, max(self.history.oldest_tick(), self.arena.tick - round(seconds*TICK_RATE)))
+        if self.predictor:
+            if state['extra']: self.predictor.load_cycle_state(state['extra'])
+            self.worker.reset()
+            # Match time went back, so the 3 second refresh counts from here
+            self.last_submit = self.arena.match_time
+            self.rec_label.config(text="Waiting...")
+            self.threat_label.config(text="Threat: --")
+            self.update_predictor()
+        print(f"Rewound to {self.arena.get_time_string()} (tick {state['tick']}), type resume to continue")
+
+    # The grid, river and bridges never change so they are drawn once and kept
+    def draw_background(self):
         cv = self.canvas
-        cv.delete('all')
         
         # Grid
-        for i in range(ARENA_W+1): cv.create_line(i*CELL, 0, i*CELL, ARENA_H*CELL, fill='#444')
-        for i in range(ARENA_H+1): cv.create_line(0, i*CELL, ARENA_W*CELL, i*CELL, fill='#444')
+        for i in range(ARENA_W+1): cv.create_line(i*CELL, 0, i*CELL, ARENA_H*CELL, fill='#444', tags='bg')
+        for i in range(ARENA_H+1): cv.create_line(0, i*CELL, ARENA_W*CELL, i*CELL, fill='#444', tags='bg')
         
         # River & bridges
-        cv.create_rectangle(0, 15*CELL, ARENA_W*CELL, 17*CELL, fill='#1e90ff')
-        cv.create_rectangle(2*CELL, 15*CELL, 5*CELL, 17*CELL, fill='#8B4513')
-        cv.create_rectangle(13*CELL, 15*CELL, 16*CELL, 17*CELL, fill='#8B4513')
+        cv.create_rectangle(0, 15*CELL, ARENA_W*CELL, 17*CELL, fill='#1e90ff', tags='bg')
+        cv.create_rectangle(2*CELL, 15*CELL, 5*CELL, 17*CELL, fill='#8B4513', tags='bg')
+        cv.create_rectangle(13*CELL, 15*CELL, 16*CELL, 17*CELL, fill='#8B4513', tags='bg')
+
+    # Turns the influence overlay on or off. Each cell gets one rectangle that stays on the
+    # canvas, and from then on only the cells the influence map marks as changed get recolored.
+    def toggle_heatmap(self):
+        cv = self.canvas
+        if self.heat_cells:
+            cv.delete('heat')
+            self.heat_cells = {}
+            print("Heatmap off")
+            return
+        for y in range(ARENA_H):
+            for x in range(ARENA_W):
+                item = cv.create_rectangle(x*CELL, y*CELL, (x+1)*CELL, (y+1)*CELL, outline='', stipple='gray50', state='hidden', tags='heat')
+                self.heat_cells[(x, y)] = [item, None]
+        # Keep it above the background but under everything drawn each frame
+        cv.tag_raise('heat', 'bg')
+        self.update_heatmap(all_cells=True)
+        print("Heatmap on")
+
+    # Red is enemy pressure (troop dps, tower coverage and incoming spells),
+    # blue is how well our own troops and towers cover the cell
+    def heat_color(self, x, y):
+        grid = self.arena.influence.grid
+        enemy = grid['red']['dps'][y][x] + grid['red']['towers'][y][x] + grid['red']['splash'][y][x]/2
+        friend = grid['blue']['dps'][y][x] + grid['blue']['towers'][y][x] + grid['blue']['splash'][y][x]/2
+        # Only 5 shades each so small changes in value don't cause a recolor
+        r, b = min(4, int(enemy/75)), min(4, int(friend/75))
+        if not r and not b: return None
+        return f"#{r*60+15:02x}20{b*60+15:02x}"
+
+    def update_heatmap(self, all_cells=False):
+        dirty = self.arena.influence.pop_dirty()
+        if not self.heat_cells: return
+        for cell in (self.heat_cells if all_cells else dirty):
+            entry = self.heat_cells[cell]
+            col = self.heat_color(*cell)
+            if col == entry[1]: continue
+            entry[1] = col
+            if col: self.canvas.itemconfig(entry[0], fill=col, state='normal')
+            else: self.canvas.itemconfig(entry[0], state='hidden')
+
+    # Create the entire arena using basic TKinter functions and some trial and error
+    # Labels and health bars are tagged 'detail' so they can be left as they are
+    # on frames where the scheduler says there's no time to redraw them
+    def draw(self, details=True):
+        cv = self.canvas
+        cv.delete('frame')
+        if details: cv.delete('detail')
+        self.update_heatmap()
         
         # Timer
-        cv.create_rectangle(ARENA_W*CELL//2-40, 5, ARENA_W*CELL//2+40, 25, fill='#333', outline='white', width=2)
-        cv.create_text(ARENA_W*CELL//2, 15, text=self.arena.get_time_string(), font=('Arial',12,'bold'), fill='white')
+        cv.create_rectangle(ARENA_W*CELL//2-40, 5, ARENA_W*CELL//2+40, 25, fill='#333', outline='white', width=2, tags='frame')
+        cv.create_text(ARENA_W*CELL//2, 15, text=self.arena.get_time_string(), font=('Arial',12,'bold'), fill='white', tags='frame')
         mode = self.arena.get_elixir_mode()
         col = '#0f0' if mode=="NORMAL" else '#f90' if mode=="DOUBLE" else '#f00'
-        cv.create_text(ARENA_W*CELL//2, 35, text=mode, font=('Arial',10,'bold'), fill=col)
+        cv.create_text(ARENA_W*CELL//2, 35, text=mode, font=('Arial',10,'bold'), fill=col, tags='frame')
         
         # Elixir
-        cv.create_rectangle(10, ARENA_H*CELL-30, 80, ARENA_H*CELL-10, fill='#1a1a3e', outline='#4169e1', width=2)
-        cv.create_text(45, ARENA_H*CELL-20, text=f"{self.arena.elixir['blue']:.1f}", font=('Arial',10,'bold'), fill='#4169e1')
-        cv.create_rectangle(10, 10, 80, 30, fill='#3e1a1a', outline='#dc143c', width=2)
-        cv.create_text(45, 20, text=f"{self.arena.elixir['red']:.1f}", font=('Arial',10,'bold'), fill='#dc143c')
+        cv.create_rectangle(10, ARENA_H*CELL-30, 80, ARENA_H*CELL-10, fill='#1a1a3e', outline='#4169e1', width=2, tags='frame')
+        cv.create_text(45, ARENA_H*CELL-20, text=f"{self.arena.elixir['blue']:.1f}", font=('Arial',10,'bold'), fill='#4169e1', tags='frame')
+        cv.create_rectangle(10, 10, 80, 30, fill='#3e1a1a', outline='#dc143c', width=2, tags='frame')
+        cv.create_text(45, 20, text=f"{self.arena.elixir['red']:.1f}", font=('Arial',10,'bold'), fill='#dc143c', tags='frame')
         
         # Spells
         for s in self.arena.spells:
             x, y, r = s.x*CELL, s.y*CELL, s.radius*CELL/2
             col = '#4169e1' if s.team=='blue' else '#dc143c'
-            cv.create_oval(x-r, y-r, x+r, y+r, outline=col, width=2, dash=(5,5))
-            cv.create_oval(x-5, y-5, x+5, y+5, fill=col, outline='white')
-            cv.create_text(x, y-r-10, text=f"{s.delay/60:.1f}s", font=('Arial',10,'bold'), fill=col)
+            cv.create_oval(x-r, y-r, x+r, y+r, outline=col, width=2, dash=(5,5), tags='frame')
+            cv.create_oval(x-5, y-5, x+5, y+5, fill=col, outline='white', tags='frame')
+            cv.create_text(x, y-r-10, text=f"{s.delay/60:.1f}s", font=('Arial',10,'bold'), fill=col, tags='frame')
         
         # Towers
         for team, towers in self.arena.towers.items():
@@ -391,33 +584,49 @@ class GUI:
                 cx, cy = t.x*CELL, t.y*CELL
                 x, y = cx - sz//2, cy - sz//2
                 col = '#4169e1' if team=='blue' else '#dc143c'
-                cv.create_rectangle(x, y, x+sz, y+sz, fill=col, outline='white', width=2)
+                cv.create_rectangle(x, y, x+sz, y+sz, fill=col, outline='white', width=2, tags='frame')
                 hp = t.health / t.max_health
                 # Add it so that if the health is low, it turns red!
-                cv.create_rectangle(x+5, y+sz+3, x+5+hp*(sz-10), y+sz+7, fill='#00ff00' if hp>0.5 else '#ff0000')
+                if details: cv.create_rectangle(x+5, y+sz+3, x+5+hp*(sz-10), y+sz+7, fill='#00ff00' if hp>0.5 else '#ff0000', tags='detail')
         
         # Units
         for u in self.arena.units:
             x, y = u.x*CELL, u.y*CELL
             col = '#4169e1' if u.team=='blue' else '#dc143c'
-            cv.create_oval(x-8, y-8, x+8, y+8, fill=col, outline='white')
-            cv.create_text(x, y, text=u.key.upper(), font=('Arial',8,'bold'), fill='white')
+            cv.create_oval(x-8, y-8, x+8, y+8, fill=col, outline='white', tags='frame')
+            if not details: continue
+            cv.create_text(x, y, text=u.key.upper(), font=('Arial',8,'bold'), fill='white', tags='detail')
             hp = u.health / u.max_health
-            cv.create_rectangle(x-10, y-15, x-10+20*hp, y-12, fill='#0f0' if hp>0.5 else '#f00')
+            cv.create_rectangle(x-10, y-15, x-10+20*hp, y-12, fill='#0f0' if hp>0.5 else '#f00', tags='detail')
+        # Old labels have to stay on top of the units drawn this frame
+        cv.tag_raise('detail')
+
+        # Frame rate and how close to real time the match is running
+        cv.create_text(ARENA_W*CELL-10, ARENA_H*CELL-20, text=self.scheduler.status(), anchor='e', font=('Arial',9), fill='#aaa', tags='frame')
 
+    # The sim ticks at a fixed 60 per second of real time, and the scheduler decides
+    # how much of the other work fits in this frame (see scheduler.py)
     def loop(self):
-        if self.arena.running:
+        sch = self.scheduler
+        for _ in range(sch.begin(self.arena.running)):
             self.arena.update()
-            self.update_predictor()
-        self.draw()
-        self.root.after(16, self.loop)
+            self.history.record(self.arena, self.predictor.cycle_state() if self.predictor else None)
+        # Also while paused, so an answer for a rewound state still shows up
+        if sch.predictor_due(): self.update_predictor()
+        if sch.draw_due(): self.draw(sch.details_due())
+        self.root.after(sch.end(), self.loop)
 
     def start(self):
         self.root.after(16, self.loop)
         self.root.mainloop()
 
+# python arena_new.py [weights.npz] to score counters with a learned evaluator
 if __name__ == "__main__":
-    GUI(Arena()).start()
+    evaluator = None
+    if len(sys.argv) > 1:
+        from evaluator import load_evaluator
+        evaluator = load_evaluator(sys.argv[1])
+    GUI(Arena(), evaluator).start()
 
 
 # Although we did some testing using the methods below, we later 
@@ -0,0 +1,218 @@
+# Made by Michael Hodis and Jonah Shatkin
+# Learned scoring for Predictor.get_counter. Instead of the hand tuned
+# damage/10 + (10-cost)*3 score, every (card, position) the predictor could play is
+# turned into the feature array of what the arena would look like right after
+# playing it, and all of them are scored by the model in one batch.
+#
+# Models are saved as .npz files:
+#   linear: w (FEATURE_SIZE,), b ()
+#   mlp:    w1 (FEATURE_SIZE, H), b1 (H,), w2 (H,), b2 ()
+#
+# Usage: python evaluator.py train <dataset_dir> <out.npz>   (fits a linear model)
+#        python evaluator.py bench <weights.npz>             (times a full batch)
+#        python evaluator.py bench-batch <games> [weights]   (get_recommendations vs one at a time)
+import sys, time
+from abc import ABC, abstractmethod
+import numpy as np
+from arena_new import Arena, ARENA_W, ARENA_H, POSITIONS, spawn_offsets
+from predictor import Predictor, CARDS, get_recommendations
+from features import (CARD_KEYS, CARD_INDEX, POSITION_KEYS, POSITION_INDEX, ELIXIR_OFFSET, HAND_OFFSET,
+                      FEATURE_SIZE, encode_states)
+
+TEAMS = ['blue', 'red']
+
+# What playing a card changes in the feature array: each troop shows up as a full
+# health unit in the cell it spawns in (same offsets and cells as add_unit and
+# encode_state), the elixir is spent and the card leaves the hand. team is needed
+# because positions are mirrored for red. Spells don't add anything to the grid,
+# so the predictor only offers them at one spot, see counter_candidates.
+def action_delta(team, card, pos):
+    delta = np.zeros(FEATURE_SIZE, dtype=np.float32)
+    info = CARDS[card]
+    delta[ELIXIR_OFFSET] = -info['elixir'] / 10
+    delta[HAND_OFFSET + CARD_INDEX[card]] = -1
+    if not info['spell']:
+        px, py = POSITIONS[team][pos]
+        for dx, dy in spawn_offsets(card):
+            x, y = min(ARENA_W-1, max(0, int(px+dx))), min(ARENA_H-1, max(0, int(py+dy)))
+            if team == 'red': y = ARENA_H-1 - y
+            delta[y*ARENA_W + x] += 1
+    return delta
+
+# Adds the played cards to a batch of state features, in place
+def apply_actions(features, team, cards, positions):
+    for i, (card, pos) in enumerate(zip(cards, positions)):
+        features[i] += action_delta(team, card, pos)
+    return features
+
+# Models are split into a linear first step (project) and the rest (finish).
+# Because playing a card only adds a fixed delta to the features, the projection
+# of a candidate is the projection of the state plus the projection of the delta.
+# So each state is projected once no matter how many candidates it has, and the
+# deltas for every possible play are projected once per model and kept in a table.
+# A model only has to fill in project and finish.
+class Evaluator(ABC):
+    def __init__(self):
+        self.last_latency, self.last_batch = 0.0, 0
+        self.deltas = None
+
+    # The linear part, (N, FEATURE_SIZE) -> (N, ...)
+    @abstractmethod
+    def project(self, x): ...
+
+    # Everything after it, down to one score per row
+    @abstractmethod
+    def finish(self, z): ...
+
+    # Scores a (N, FEATURE_SIZE) batch, higher is better for us
+    def forward(self, x):
+        return self.finish(self.project(x))
+
+    # Projected deltas for every (team, card, position), worked out the first time they're needed
+    def delta_table(self):
+        if self.deltas is None:
+            rows = [action_delta(team, card, pos) for team in TEAMS for card in CARD_KEYS for pos in POSITION_KEYS]
+            z = self.project(np.array(rows))
+            self.deltas = z.reshape((len(TEAMS), len(CARD_KEYS), len(POSITION_KEYS)) + z.shape[1:])
+        return self.deltas
+
+    # One batch for every candidate (card, position). Returns a list of scores and
+    # keeps how long it took so it can be reported.
+    def score(self, predictor, candidates):
+        return self.score_many([(predictor.arena, predictor.team, predictor.hand, candidates)])[0]
+
+    # Same thing for many games in a single forward pass. jobs is a list of
+    # (arena, team, hand, candidates), and one list of scores comes back for each.
+    def score_many(self, jobs):
+        start = time.perf_counter()
+        total = sum(len(job[3]) for job in jobs)
+        if not total: return [[] for _ in jobs]
+        states = encode_states([job[:3] for job in jobs])
+        owner, teams, cards, positions = [], [], [], []
+        for j, (_, team, _, candidates) in enumerate(jobs):
+            owner += [j] * len(candidates)
+            teams += [TEAMS.index(team)] * len(candidates)
+            cards += [CARD_INDEX[c] for c, _ in candidates]
+            positions += [POSITION_INDEX[p] for _, p in candidates]
+        z = self.project(states)[owner] + self.delta_table()[teams, cards, positions]
+        scores = self.finish(z).tolist()
+        results, row = [], 0
+        for *_, candidates in jobs:
+            results.append(scores[row:row+len(candidates)])
+            row += len(candidates)
+        self.last_latency, self.last_batch = time.perf_counter() - start, total
+        return results
+
+class LinearEvaluator(Evaluator):
+    def __init__(self, w, b=0.0):
+        super().__init__()
+        self.w, self.b = np.asarray(w, dtype=np.float32), float(b)
+
+    def project(self, x):
+        return x @ self.w
+
+    def finish(self, z):
+        return z + self.b
+
+class MLPEvaluator(Evaluator):
+    def __init__(self, w1, b1, w2, b2=0.0):
+        super().__init__()
+        self.w1, self.b1 = np.asarray(w1, dtype=np.float32), np.asarray(b1, dtype=np.float32)
+        self.w2, self.b2 = np.asarray(w2, dtype=np.float32), float(b2)
+
+    def project(self, x):
+        return x @ self.w1
+
+    def finish(self, z):
+        return np.maximum(z + self.b1, 0) @ self.w2 + self.b2
+
+# Picks the model type from which arrays are in the file
+def load_evaluator(path):
+    data = np.load(path)
+    if 'w1' in data: model = MLPEvaluator(data['w1'], data['b1'], data['w2'], data['b2'])
+    elif 'w' in data: model = LinearEvaluator(data['w'], data['b'])
+    else: raise ValueError(f"{path} has no evaluator weights")
+    size = (model.w1 if isinstance(model, MLPEvaluator) else model.w).shape[0]
+    if size != FEATURE_SIZE: raise ValueError(f"{path} expects {size} features, not {FEATURE_SIZE}")
+    return model
+
+# Ridge regression of the match outcome on the state right after each play in a
+# self-play dataset (see selfplay.py). Waiting samples are left out.
+def train_linear(dataset_dir, out_path, ridge=1.0, batch_size=4096):
+    from selfplay import DatasetReader
+    reader = DatasetReader(dataset_dir)
+    xtx = np.zeros((FEATURE_SIZE+1, FEATURE_SIZE+1))
+    xty = np.zeros(FEATURE_SIZE+1)
+    for batch in reader.batches(batch_size):
+        batch = batch[batch['card'] >= 0]
+        for team_id, team in enumerate(['blue', 'red']):
+            rows = batch[batch['team'] == team_id]
+            if not len(rows): continue
+            x = rows['features'].astype(np.float64)
+            # Dataset states are from before the play, so add the play the same way score() does
+            apply_actions(x, team, [CARD_KEYS[c] for c in rows['card']], [POSITION_KEYS[p] for p in rows['position']])
+            x = np.hstack([x, np.ones((len(x), 1))])
+            xtx += x.T @ x
+            xty += x.T @ rows['outcome']
+    wb = np.linalg.solve(xtx + ridge*np.eye(FEATURE_SIZE+1), xty)
+    np.savez(out_path, w=wb[:-1].astype(np.float32), b=np.float32(wb[-1]))
+    return LinearEvaluator(wb[:-1], wb[-1])
+
+# Times a full batch: every card in the game at every position
+def benchmark(model, repeats=100):
+    arena = Arena()
+    arena.verbose = False
+    p = Predictor(arena, 'blue', evaluator=model)
+    p.hand = CARD_KEYS[:4]
+    candidates = [(c, pos) for c in CARD_KEYS for pos in POSITION_KEYS]
+    times = []
+    for _ in range(repeats):
+        model.score(p, candidates)
+        times.append(model.last_latency)
+    times.sort()
+    print(f"{len(candidates)} candidates: median {times[len(times)//2]*1000:.3f} ms, worst {times[-1]*1000:.3f} ms")
+    return times
+
+# Times get_recommendations against one Predictor per game on the same games, which
+# are arenas from the verify.py scenarios every second of the first 30
+def benchmark_batch(model=None, games=300, repeats=20):
+    import random
+    from verify import SCENARIOS, play
+    arenas = []
+    for scenario in SCENARIOS.values():
+        arena = Arena()
+        arena.verbose = False
+        for tick, _ in play(arena, scenario, 1800):
+            if tick % 60 == 0: arenas.append(arena.snapshot())
+    rng = random.Random(0)
+    batch = [(arenas[i//2 % len(arenas)], TEAMS[i % 2], rng.sample(CARD_KEYS, 4)) for i in range(games)]
+
+    def one_by_one():
+        results = []
+        for arena, team, hand in batch:
+            p = Predictor(arena, team, model)
+            p.hand = hand
+            results.append(p.get_recommendation(force=True))
+        return results
+
+    times = {}
+    for name, run in [('one by one', one_by_one), ('batched', lambda: get_recommendations(batch, model))]:
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+        times[name] = best
+        print(f"{name}: {best*1000:.2f} ms for {games} games ({best/games*1e6:.1f} us each)")
+    return times
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == 'train':
+        train_linear(sys.argv[2], sys.argv[3])
+        print(f"Saved linear evaluator to {sys.argv[3]}")
+    elif len(sys.argv) == 3 and sys.argv[1] == 'bench':
+        benchmark(load_evaluator(sys.argv[2]))
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == 'bench-batch':
+        benchmark_batch(load_evaluator(sys.argv[3]) if len(sys.argv) == 4 else None, int(sys.argv[2]))
+    else:
+        print("Usage: python evaluator.py train <dataset_dir> <out.npz> | bench <weights.npz> | bench-batch <games> [weights.npz]")
@@ -0,0 +1,71 @@
+# Made by Michael Hodis and Jonah Shatkin
+# Turns an arena into a fixed size array of numbers so it can be saved for training
+# or fed to a learned evaluator. Everything is from one team's point of view and
+# the red side is flipped so "our" half of the arena is always at the bottom.
+import numpy as np
+from arena_new import ARENA_W, ARENA_H, POSITIONS
+from predictor import CARDS
+
+# Cards you can actually put in a deck (the princess tower is in the json too)
+CARD_KEYS = sorted(k for k, v in CARDS.items() if not isinstance(v.get('elixir'), str))
+CARD_INDEX = {k: i for i, k in enumerate(CARD_KEYS)}
+POSITION_KEYS = sorted(POSITIONS['blue'])
+POSITION_INDEX = {k: i for i, k in enumerate(POSITION_KEYS)}
+
+# Layout of the array:
+#   2 x ARENA_H x ARENA_W  unit health per cell (ours, then theirs), as a fraction of max
+#   6                      tower health fractions (our left/right/king, then theirs)
+#   2                      elixir (ours, theirs) out of 10
+#   len(CARD_KEYS)         1 for every card in our hand
+GRID_SIZE = 2 * ARENA_H * ARENA_W
+TOWER_OFFSET = GRID_SIZE
+ELIXIR_OFFSET = TOWER_OFFSET + 6
+HAND_OFFSET = ELIXIR_OFFSET + 2
+FEATURE_SIZE = HAND_OFFSET + len(CARD_KEYS)
+
+def encode_state(arena, team, hand, out=None):
+    enemy = 'red' if team == 'blue' else 'blue'
+    f = np.zeros(FEATURE_SIZE, dtype=np.float32) if out is None else out
+    if out is not None: f[:] = 0
+    grid = f[:GRID_SIZE].reshape(2, ARENA_H, ARENA_W)
+    for u in arena.units:
+        x, y = min(ARENA_W-1, max(0, int(u.x))), min(ARENA_H-1, max(0, int(u.y)))
+        if team == 'red': y = ARENA_H-1 - y
+        grid[0 if u.team == team else 1, y, x] += u.health / u.max_health
+    for i, side in enumerate([team, enemy]):
+        for j, name in enumerate(['left', 'right', 'king']):
+            t = arena.towers[side][name]
+            f[TOWER_OFFSET + i*3 + j] = max(0, t.health) / t.max_health
+    f[ELIXIR_OFFSET] = arena.elixir[team] / arena.max_elixir
+    f[ELIXIR_OFFSET + 1] = arena.elixir[enemy] / arena.max_elixir
+    for card in hand:
+        if card in CARD_INDEX: f[HAND_OFFSET + CARD_INDEX[card]] = 1
+    return f
+
+# encode_state for many (arena, team, hand) at once, one row each. The units of an
+# arena are only read once even when both of its teams are in the list, and the
+# grids for every row are filled in with a single numpy call.
+def encode_states(games, out=None):
+    f = np.zeros((len(games), FEATURE_SIZE), dtype=np.float32) if out is None else out
+    if out is not None: f[:] = 0
+    units, rows, cells, values = {}, [], [], []
+    for i, (arena, team, hand) in enumerate(games):
+        if id(arena) not in units:
+            units[id(arena)] = [(min(ARENA_W-1, max(0, int(u.x))), min(ARENA_H-1, max(0, int(u.y))),
+                                 u.team, u.health / u.max_health) for u in arena.units]
+        for x, y, side, value in units[id(arena)]:
+            if team == 'red': y = ARENA_H-1 - y
+            rows.append(i)
+            cells.append((0 if side == team else ARENA_H*ARENA_W) + y*ARENA_W + x)
+            values.append(value)
+        enemy = 'red' if team == 'blue' else 'blue'
+        for j, side in enumerate([team, enemy]):
+            for k, name in enumerate(['left', 'right', 'king']):
+                t = arena.towers[side][name]
+                f[i, TOWER_OFFSET + j*3 + k] = max(0, t.health) / t.max_health
+        f[i, ELIXIR_OFFSET] = arena.elixir[team] / arena.max_elixir
+        f[i, ELIXIR_OFFSET + 1] = arena.elixir[enemy] / arena.max_elixir
+        for card in hand:
+            if card in CARD_INDEX: f[i, HAND_OFFSET + CARD_INDEX[card]] = 1
+    if rows: np.add.at(f, (rows, cells), np.array(values, dtype=np.float32))
+    return f
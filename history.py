@@ -0,0 +1,129 @@
+# Made by Michael Hodis and Jonah Shatkin
+# Remembers the last part of the match so the GUI can rewind it.
+# Every tick only what changed since the tick before is saved (a delta), and every
+# SNAPSHOT_EVERY ticks a full copy is saved too. A snapshot and the deltas after it
+# make up a segment. Rewinding starts at the closest snapshot before the tick we want
+# and applies at most SNAPSHOT_EVERY deltas, so it never has to replay the match from
+# the start. When the history gets bigger than the memory cap the oldest segment goes.
+#
+# States are the plain dicts from Arena.compact(), plus an 'extra' value for anything
+# outside the arena that has to go back with it (the GUI keeps the card cycles there).
+# It's only saved in a delta on the ticks it changes.
+import copy
+
+# Two seconds of match time per segment
+SNAPSHOT_EVERY = 120
+# Default cap on how much memory the history can use
+MAX_BYTES = 16 * 1024 * 1024
+# Rough cost of one number or string reference stored in the history, plus the
+# overhead of each dict/tuple, used to estimate memory without walking every object
+NUMBER_BYTES, ENTRY_BYTES = 8, 64
+
+# What changed between two compact states
+def make_delta(old, new):
+    delta = {'tick': new['tick'], 'elixir': new['elixir'], 'next_uid': new['next_uid']}
+    delta['towers'] = {k: v for k, v in new['towers'].items() if old['towers'].get(k) != v}
+    # Units that were already there only need their moving parts
+    moved, added = {}, {}
+    for uid, u in new['units'].items():
+        if uid not in old['units']: added[uid] = u
+        elif old['units'][uid] != u: moved[uid] = u[3:]
+    delta['moved'], delta['added'] = moved, added
+    delta['gone'] = [uid for uid in old['units'] if uid not in new['units']]
+    delta['spells'] = {uid: s for uid, s in new['spells'].items() if old['spells'].get(uid) != s}
+    delta['spells_gone'] = [uid for uid in old['spells'] if uid not in new['spells']]
+    if new.get('extra') != old.get('extra'): delta['extra'] = new.get('extra')
+    return delta
+
+# Applies a delta to a compact state, in place
+def apply_delta(state, delta):
+    state['tick'], state['elixir'], state['next_uid'] = delta['tick'], delta['elixir'], delta['next_uid']
+    state['towers'].update(delta['towers'])
+    for uid in delta['gone']: del state['units'][uid]
+    for uid, moving in delta['moved'].items(): state['units'][uid] = state['units'][uid][:3] + moving
+    state['units'].update(delta['added'])
+    for uid in delta['spells_gone']: del state['spells'][uid]
+    state['spells'].update(delta['spells'])
+    if 'extra' in delta: state['extra'] = delta['extra']
+
+def estimate_bytes(delta):
+    numbers = 4 + 2*len(delta['towers']) + 4*len(delta['moved']) + 7*len(delta['added'])
+    numbers += len(delta['gone']) + 5*len(delta['spells']) + len(delta['spells_gone'])
+    entries = 1 + len(delta['moved']) + len(delta['added']) + len(delta['spells']) + ('extra' in delta)
+    return numbers*NUMBER_BYTES + entries*ENTRY_BYTES
+
+def estimate_state_bytes(state):
+    return (4 + 2*len(state['towers']) + 7*len(state['units']) + 5*len(state['spells'])) * NUMBER_BYTES \
+        + (1 + len(state['towers']) + len(state['units']) + len(state['spells'])) * ENTRY_BYTES
+
+class History:
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes, self.bytes = max_bytes, 0
+        # Each segment is {'snapshot': state, 'deltas': [...], 'bytes': n}, oldest first
+        self.segments = []
+        self.prev = None
+
+    def clear(self):
+        self.segments, self.prev, self.bytes = [], None, 0
+
+    def oldest_tick(self):
+        return self.segments[0]['snapshot']['tick'] if self.segments else None
+
+    def newest_tick(self):
+        return self.prev['tick'] if self.prev else None
+
+    # Call once per tick with the arena. If the tick isn't past the newest one we have,
+    # the match was rewound and carried on from there, so the old future is dropped first.
+    def record(self, arena, extra=None):
+        state = arena.compact()
+        state['extra'] = extra
+        if self.prev and state['tick'] <= self.prev['tick']: self.truncate(state['tick'] - 1)
+        last = self.segments[-1] if self.segments else None
+        if last is None or state['tick'] - last['snapshot']['tick'] >= SNAPSHOT_EVERY:
+            size = estimate_state_bytes(state)
+            self.segments.append({'snapshot': copy.deepcopy(state), 'deltas': [], 'bytes': size})
+        else:
+            delta = make_delta(self.prev, state)
+            size = estimate_bytes(delta)
+            last['deltas'].append(delta)
+            last['bytes'] += size
+        self.bytes += size
+        self.prev = state
+        # Drop the oldest segments, but always keep the one we're writing to
+        while self.bytes > self.max_bytes and len(self.segments) > 1:
+            self.bytes -= self.segments.pop(0)['bytes']
+
+    # The compact state at a tick (or the closest one we still have), or None if empty
+    def state_at(self, tick):
+        if not self.segments: return None
+        seg = self.segments[0]
+        for s in self.segments:
+            if s['snapshot']['tick'] <= tick: seg = s
+        state = copy.deepcopy(seg['snapshot'])
+        for delta in seg['deltas']:
+            if delta['tick'] > tick: break
+            apply_delta(state, delta)
+        return state
+
+    # Puts the arena back to a tick and returns the state it actually got to
+    # (its 'tick' and 'extra' are what the caller needs), or None if empty
+    def restore(self, arena, tick):
+        state = self.state_at(tick)
+        if state is None: return None
+        arena.load_compact(state)
+        return state
+
+    # Forgets everything after a tick, so recording can carry on from there
+    # (record does this on its own when the match carries on after a rewind)
+    def truncate(self, tick):
+        while self.segments and self.segments[-1]['snapshot']['tick'] > tick:
+            self.bytes -= self.segments.pop()['bytes']
+        if not self.segments:
+            self.prev = None
+            return
+        seg = self.segments[-1]
+        while seg['deltas'] and seg['deltas'][-1]['tick'] > tick:
+            size = estimate_bytes(seg['deltas'].pop())
+            seg['bytes'] -= size
+            self.bytes -= size
+        self.prev = self.state_at(tick)
@@ -0,0 +1,141 @@
+# Made by Michael Hodis and Jonah Shatkin
+# Per-cell influence map of the arena. Every unit, tower and pending spell "stamps"
+# its area of effect onto a grid for its team. Instead of rebuilding the whole grid
+# every frame, we only re-stamp a unit when it walks into a new cell, so the cost
+# of keeping it up to date depends on how much moves and not on the size of the arena.
+import math, copy
+
+# Same 12 tile falloff the predictor has always used for its threat heuristic
+THREAT_RANGE = 12
+
+# The layers that are kept for each team
+#   dps      - damage per second a team's troops can deal to each cell right now
+#   pressure - troop damage with the 12 tile falloff, measured cell to cell (for lane choice)
+#   towers   - damage per second the team's towers cover each cell with
+#   splash   - damage of the team's spells that are about to land on each cell
+LAYERS = ['dps', 'pressure', 'towers', 'splash']
+
+class InfluenceMap:
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.grid = {}
+        for team in ['blue', 'red']:
+            self.grid[team] = {}
+            for layer in LAYERS:
+                self.grid[team][layer] = [[0.0]*width for _ in range(height)]
+        # Whatever is stamped right now, keyed by the object that stamped it.
+        # Units are stored with the cell they were stamped from.
+        self.stamps = {}
+        # Cells that changed since the GUI last asked, so it only redraws those
+        self.dirty = set()
+        self._stencils = {}
+
+    # All the (dx, dy, distance) offsets within radius r of a cell, cached per radius
+    # because only a handful of different radiuses exist in the card data
+    def stencil(self, r):
+        if r not in self._stencils:
+            cells, n = [], int(math.ceil(r))
+            for dy in range(-n, n+1):
+                for dx in range(-n, n+1):
+                    d = math.sqrt(dx*dx + dy*dy)
+                    if d <= r: cells.append((dx, dy, d))
+            self._stencils[r] = cells
+        return self._stencils[r]
+
+    def cell_of(self, x, y):
+        return (min(self.width-1, max(0, int(x))), min(self.height-1, max(0, int(y))))
+
+    def get(self, team, layer, x, y):
+        cx, cy = self.cell_of(x, y)
+        return self.grid[team][layer][cy][cx]
+
+    # Adds (sign=1) or removes (sign=-1) one stamp from the grid
+    def _apply(self, team, cell, parts, sign):
+        cx, cy = cell
+        for layer, r, value, falloff in parts:
+            g = self.grid[team][layer]
+            for dx, dy, d in self.stencil(r):
+                x, y = cx+dx, cy+dy
+                if 0 <= x < self.width and 0 <= y < self.height:
+                    v = value * (r-d) / r if falloff else value
+                    if v:
+                        g[y][x] += sign*v
+                        # Clamp float noise so cells go back to exactly 0 when empty
+                        if abs(g[y][x]) < 1e-6: g[y][x] = 0.0
+                        self.dirty.add((x, y))
+
+    # Everything a unit contributes to the map, from the json stats it was made with
+    def _unit_parts(self, u):
+        return [('dps', u.attack_radius, u.damage / u.hitspeed, False),
+                ('pressure', THREAT_RANGE, u.damage, True)]
+
+    def _stamp(self, obj, team, cell, parts):
+        self._apply(team, cell, parts, 1)
+        self.stamps[obj] = (team, cell, parts)
+
+    def _unstamp(self, obj):
+        team, cell, parts = self.stamps.pop(obj)
+        self._apply(team, cell, parts, -1)
+
+    # Called by Arena.update once per tick. Only units that changed cell, spawned
+    # or died touch the grid, the rest is just a dictionary lookup per object.
+    def update(self, arena):
+        alive = set()
+        for u in arena.units:
+            if u.health <= 0: continue
+            alive.add(u)
+            cell = self.cell_of(u.x, u.y)
+            old = self.stamps.get(u)
+            if old and old[1] == cell: continue
+            if old: self._unstamp(u)
+            self._stamp(u, u.team, cell, self._unit_parts(u))
+
+        for team, towers in arena.towers.items():
+            for t in towers.values():
+                if t.health <= 0: continue
+                alive.add(t)
+                if t not in self.stamps:
+                    # Towers are centered on half tiles so stamp from the exact middle cell
+                    self._stamp(t, team, self.cell_of(t.x, t.y), [('towers', t.attack_radius, t.damage / t.hitspeed, False)])
+
+        for s in arena.spells:
+            alive.add(s)
+            if s not in self.stamps:
+                self._stamp(s, s.team, self.cell_of(s.x, s.y), [('splash', s.radius, s.damage, False)])
+
+        # Anything still stamped that wasn't seen this tick died, landed or got removed
+        for obj in [o for o in self.stamps if o not in alive]:
+            self._unstamp(obj)
+
+    # Throws everything away and stamps the arena again from nothing.
+    # Only needed when the arena gets replaced wholesale.
+    def rebuild(self, arena):
+        for team in self.grid.values():
+            for g in team.values():
+                for row in g:
+                    for x in range(self.width): row[x] = 0.0
+        self.stamps = {}
+        self.dirty = set((x, y) for y in range(self.height) for x in range(self.width))
+        self.update(arena)
+
+    # Used by Arena.snapshot. The grid rows are plain copies and the stencils are
+    # shared since they never change, which makes this a lot faster than a real deepcopy.
+    def __deepcopy__(self, memo):
+        m = InfluenceMap.__new__(InfluenceMap)
+        memo[id(self)] = m
+        m.width, m.height, m._stencils = self.width, self.height, self._stencils
+        m.grid = {}
+        for team, layers in self.grid.items():
+            m.grid[team] = {}
+            for layer, g in layers.items():
+                m.grid[team][layer] = [row[:] for row in g]
+        m.stamps = {}
+        for obj, stamp in self.stamps.items():
+            m.stamps[copy.deepcopy(obj, memo)] = stamp
+        m.dirty = set(self.dirty)
+        return m
+
+    # Hands the changed cells to whoever is drawing them and starts over
+    def pop_dirty(self):
+        cells, self.dirty = self.dirty, set()
+        return cells
@@ -1,6 +1,11 @@
 # Made by Michael Hodis and Jonah Shatkin
 # Clash Royale Predictor that recommends best card to play
-import math, json
+import math, json, functools
+from collections import deque
+
+# Only get_recommendations needs numpy, everything else works without it
+try: import numpy as np
+except ImportError: np = None
 
 try:
     with open('clash_royale_cards.json', 'r') as f:
@@ -33,43 +38,164 @@ POSITIONS = {
     }
 }
 
+# The part of the counter score that only depends on the two cards, shared by
+# every predictor (and every game in get_recommendations) so it's only worked out once
+@functools.lru_cache(maxsize=None)
+def counter_score(etype, card):
+    info = CARDS.get(card,{})
+    cost, ctype = info.get('elixir',10), info.get('type','')
+    if etype in ['tank','minitank'] and ctype=='swarm': score = 50
+    elif etype in ['swarm','rangedswarm'] and info.get('spell'): score = 50
+    elif etype=='tank' and info.get('damage',0) > 300: score = 40
+    else: score = info.get('damage',0) / 10
+    return score + (10-cost) * 3
+
+# A deck of 8 cards going round: 4 in hand and 4 waiting in line. The card you
+# play goes to the back of the line and the one at the front comes into your hand.
+# Cards we haven't seen yet are unknown (None in the line, or counted in `unknown`
+# for the hand) and get filled in as they get played, so after 4 plays the whole
+# line is known and after 8 the whole deck is. Every update is a fixed amount of
+# work no matter how long the match has been going.
+class CardCycle:
+    def __init__(self):
+        self.hand, self.queue, self.unknown = [], deque([None]*4), 4
+        self.seen = set()
+
+    def copy(self):
+        c = CardCycle()
+        c.hand, c.queue, c.unknown, c.seen = list(self.hand), deque(self.queue), self.unknown, set(self.seen)
+        return c
+
+    # Everything about the cycle as one tuple, so it can be compared and saved (e.g. for rewinding)
+    def state(self):
+        return (tuple(self.hand), tuple(self.queue), self.unknown, frozenset(self.seen))
+
+    def load_state(self, state):
+        hand, queue, self.unknown, seen = state
+        self.hand, self.queue, self.seen = list(hand), deque(queue), set(seen)
+
+    # All 8 cards, the first 4 are the starting hand and the rest are in order
+    def set_deck(self, cards):
+        cards = list(cards[:8])
+        self.hand, self.unknown = cards[:4], 4 - len(cards[:4])
+        self.queue = deque(cards[4:] + [None]*(4 - len(cards[4:])))
+        self.seen = set(cards)
+
+    def set_hand(self, cards):
+        self.hand = list(cards[:4])
+        self.unknown = 4 - len(self.hand)
+        self.seen.update(self.hand)
+
+    def set_next(self, card):
+        self.queue[0] = card
+        if card: self.seen.add(card)
+
+    @property
+    def next(self):
+        return self.queue[0]
+
+    # Returns False if the card can't have been in the hand
+    def play(self, card):
+        if card in self.hand: self.hand.remove(card)
+        elif self.unknown and card not in self.queue: self.unknown -= 1
+        else: return False
+        self.seen.add(card)
+        incoming = self.queue.popleft()
+        if incoming: self.hand.append(incoming)
+        else: self.unknown += 1
+        self.queue.append(card)
+        return True
+
+    # Every card that could be in the hand right now. Unknown slots can only be
+    # cards we haven't seen, because every card we've seen is either in the hand or the line.
+    def possible_hand(self):
+        if not self.unknown: return list(self.hand)
+        unseen = [c for c in CARDS if c not in self.seen and not isinstance(CARDS[c].get('elixir'), str)]
+        return list(self.hand) + unseen
+
 class Predictor:
-    def __init__(self, arena, team='blue'):
-        self.arena, self.team = arena, team
+    # evaluator is optional (see evaluator.py). Without one, counters are picked
+    # with the hand written score in get_counter.
+    def __init__(self, arena, team='blue', evaluator=None):
+        self.arena, self.team, self.evaluator = arena, team, evaluator
         self.enemy = 'red' if team == 'blue' else 'blue'
-        self.hand, self.next_card = [], None
+        # Our own cycle and what we've worked out about the opponent's from their plays
+        self.cycle, self.enemy_cycle = CardCycle(), CardCycle()
         self.last_update, self.recommendation = 0, None
 
+    # The hand and next card live in the cycle
+    @property
+    def hand(self): return self.cycle.hand
+
+    @hand.setter
+    def hand(self, cards): self.cycle.set_hand(cards)
+
+    @property
+    def next_card(self): return self.cycle.next
+
+    @next_card.setter
+    def next_card(self, card): self.cycle.set_next(card)
+
+    # A copy that works on a different arena (e.g. a snapshot for the background worker)
+    def clone(self, arena):
+        p = Predictor(arena, self.team, self.evaluator)
+        p.cycle, p.enemy_cycle = self.cycle.copy(), self.enemy_cycle.copy()
+        return p
+
+    # Both cycles, ours and the opponent's, and putting them back
+    def cycle_state(self):
+        return self.cycle.state(), self.enemy_cycle.state()
+
+    def load_cycle_state(self, state):
+        self.cycle.load_state(state[0])
+        self.enemy_cycle.load_state(state[1])
+        self.recommendation = None
+
+    # A predictor playing for the other side on the given arena. Used to guess their
+    # reply in rollouts, so it holds every card that could be in their hand right now
+    # (see CardCycle.possible_hand) and picks one reply from only those.
+    def opponent(self, arena):
+        p = Predictor(arena, self.enemy)
+        p.cycle = self.enemy_cycle.copy()
+        p.cycle.hand = self.enemy_cycle.possible_hand()
+        return p
+
     # Each clash game starts with your hand of 4 cards. 
     # The other 4 cards are also randomized so you don't 
     # know what you're going to start with each round.
     def set_hand(self, cards):
-        self.hand = list(cards[:4])
+        self.hand = cards
         # Replaced list comprehension for printing
         card_names_list = []
         for c in self.hand:
             card_names_list.append(NAMES.get(c, c))
         print(f"Hand: {card_names_list}")
 
-    # We could add a queue in the future in order to not have 
-    # to keep calling this after the first 4 times, but we ran out of time.
+    # With the whole deck the cycle takes care of itself and set_next isn't needed anymore
+    def set_deck(self, cards):
+        self.cycle.set_deck(cards)
+        card_names_list = []
+        for c in self.hand:
+            card_names_list.append(NAMES.get(c, c))
+        print(f"Hand: {card_names_list} | Next: {NAMES.get(self.next_card,'?')}")
+
+    # Still works for telling the predictor which card is coming next
     def set_next(self, card):
         self.next_card = card
         print(f"Next: {NAMES.get(card,card)}")
 
     def play_card(self, card):
-        if card in self.hand:
-            self.hand.remove(card)
-            if self.next_card:
-                self.hand.append(self.next_card)
-                self.next_card = None
-            
+        if self.cycle.play(card):
             # Replaced list comprehension for printing
             card_names_list = []
             for c in self.hand:
                 card_names_list.append(NAMES.get(c, c))
             print(f"Played: {NAMES.get(card,card)} | Hand: {card_names_list}")
 
+    # The opponent played a card, which tells us a bit more about their cycle
+    def on_enemy_played(self, card):
+        self.enemy_cycle.play(card)
+
     # This is how we see what the threat it and use this as our heuristic in the future
 
     # Algorithm:
@@ -80,6 +206,8 @@ class Predictor:
     # Closer enemy = higher multiplier
     # Higher damage enemy = more threat
 
+    # This stays an exact sum over the real positions. The influence map's 'pressure'
+    # layer is snapped to grid cells, so it's only close enough for picking a lane.
     def get_threat(self):
         threat = 0
         for u in self.arena.units:
@@ -94,6 +222,39 @@ class Predictor:
     # This encourages positive elixir trades but is also greedy and could use a card 
     # Like arrows and leave us unprepared for another push
     def get_counter(self, enemy):
+        return self.get_counter_placement(enemy)[0]
+
+    # The counter card and where to play it. With an evaluator every card we could
+    # play goes in at every position, and they are all scored in one batch.
+    def get_counter_placement(self, enemy):
+        if not self.evaluator:
+            card = self._heuristic_counter(enemy)
+            return card, self.get_position(card, True) if card else None
+        candidates = self.counter_candidates(enemy)
+        if not candidates: return None, None
+        scores = self.evaluator.score(self, candidates)
+        return candidates[scores.index(max(scores))]
+
+    # Every (card, position) we can afford that can actually hit the enemy
+    def counter_candidates(self, enemy):
+        elixir, candidates = self.arena.elixir[self.team], []
+        for card in self.hand:
+            info = CARDS.get(card,{})
+            cost = info.get('elixir',10)
+            if isinstance(cost,str) or cost > elixir: 
+                continue
+            if enemy.flying and info.get('targets')=='ground': 
+                continue
+            if info.get('spell'):
+                # The model can't tell where a spell lands, so it only gets offered
+                # at the spot closest to the troop it's meant to hit
+                spots = POSITIONS[self.team]
+                candidates.append((card, min(spots, key=lambda p: enemy.dist(*spots[p]))))
+                continue
+            for pos in POSITIONS[self.team]: candidates.append((card, pos))
+        return candidates
+
+    def _heuristic_counter(self, enemy):
         etype, flying = CARDS.get(enemy.key,{}).get('type',''), enemy.flying
         elixir, best, best_score = self.arena.elixir[self.team], None, -999
         
@@ -105,13 +266,7 @@ class Predictor:
             if flying and info.get('targets')=='ground': 
                 continue
             
-            ctype = info.get('type','')
-            if etype in ['tank','minitank'] and ctype=='swarm': score = 50
-            elif etype in ['swarm','rangedswarm'] and info.get('spell'): score = 50
-            elif etype=='tank' and info.get('damage',0) > 300: score = 40
-            else: score = info.get('damage',0) / 10
-            score += (10-cost) * 3
-            
+            score = counter_score(etype, card)
             if score > best_score: best, best_score = card, score
         return best
 
@@ -140,17 +295,48 @@ class Predictor:
     # 4. Support troops:
     # bl or br (bridge positions)
     # Aggressive placement at the bridge
+    # With an influence map, defense and spells go to the lane with more enemy
+    # pressure on our princess tower, and support troops avoid a bridge that is
+    # covered by enemy troops or about to get hit by a spell.
     def get_position(self, card, defensive=False):
         if defensive: 
+            lane = self._busier_lane()
+            if lane: return 't' + lane
             enemies = [u for u in self.arena.units if u.team == self.enemy]
             return ('tl' if enemies[0].x < 9 else 'tr') if enemies else 'tl'
         info = CARDS.get(card,{})
         if info.get('spell'):
+            lane = self._busier_lane()
+            if lane: return 'b' + lane
             enemies = [u for u in self.arena.units if u.team == self.enemy]
             return ('bl' if enemies[0].x < 9 else 'br') if enemies else 'bl'
         if info.get('type')=='tank': return 'fl' if self.arena.match_time % 4 < 2 else 'fr'
+        safe = self._safer_bridge()
+        if safe: return safe
         return 'bl' if self.arena.match_time % 2 < 1 else 'br'
 
+    # 'l' or 'r' for whichever of our princess towers has more enemy pressure on it,
+    # None if there's no influence map or both sides are the same
+    def _busier_lane(self):
+        influence = getattr(self.arena, 'influence', None)
+        if not influence: return None
+        towers = self.arena.towers[self.team]
+        l = influence.get(self.enemy, 'pressure', towers['left'].x, towers['left'].y)
+        r = influence.get(self.enemy, 'pressure', towers['right'].x, towers['right'].y)
+        if l == r: return None
+        return 'l' if l > r else 'r'
+
+    # The bridge where our troop would take the least enemy dps and spell damage
+    def _safer_bridge(self):
+        influence = getattr(self.arena, 'influence', None)
+        if not influence: return None
+        danger = {}
+        for pos in ['bl', 'br']:
+            x, y = POSITIONS[self.team][pos]
+            danger[pos] = influence.get(self.enemy, 'dps', x, y) + influence.get(self.enemy, 'splash', x, y)
+        if danger['bl'] == danger['br']: return None
+        return 'bl' if danger['bl'] < danger['br'] else 'br'
+
     # Custom key function for sorting enemy units by nearest tower distance (Replaces lambda)
     def _sort_by_nearest_tower(self, u):
         min_d = float('inf')
@@ -161,6 +347,12 @@ class Predictor:
                     min_d = d
         return min_d
 
+    # The enemy closest to one of our towers, which is the one we need to counter
+    def _nearest_enemy(self):
+        enemies = [u for u in self.arena.units if u.team == self.enemy]
+        # Replaced sort key lambda with a custom method
+        return min(enemies, key=self._sort_by_nearest_tower) if enemies else None
+
     # Use a tree searching method to get the best reccomendation
     def get_recommendation(self, force=False):
         now = self.arena.match_time
@@ -168,7 +360,14 @@ class Predictor:
             return self.recommendation
         
         self.last_update = now
-        elixir, threat = self.arena.elixir[self.team], self.get_threat()
+        self.recommendation = self._recommend(self.get_threat(), self._nearest_enemy, self.get_counter_placement)
+        return self.recommendation
+
+    # The decision itself. nearest_enemy and counter_placement are passed in as functions
+    # so they are only worked out when we're actually defending, and so
+    # get_recommendations can hand in answers it already worked out for many games at once.
+    def _recommend(self, threat, nearest_enemy, counter_placement):
+        elixir = self.arena.elixir[self.team]
         
         # Using this method, we can input any number of things into this method as we want!
         def create_recommendation(**kwargs):
@@ -177,27 +376,20 @@ class Predictor:
             return result
 
         if not self.hand:
-            self.recommendation = create_recommendation(card=None,card_name='Set hand',position=None,elixir_cost=0,reason='Use: hand <4 cards>')
-            return self.recommendation
+            return create_recommendation(card=None,card_name='Set hand',position=None,elixir_cost=0,reason='Use: hand <4 cards>')
 
-        enemies = [u for u in self.arena.units if u.team == self.enemy]
-        
-        if threat > 50 and enemies:
-            # Replaced sort key lambda with a custom method
-            enemies.sort(key=self._sort_by_nearest_tower)
-            card = self.get_counter(enemies[0])
+        enemy = nearest_enemy() if threat > 50 else None
+        if enemy:
+            card, pos = counter_placement(enemy)
             if card:
-                self.recommendation = create_recommendation(card=card,card_name=NAMES.get(card,card),position=self.get_position(card,True),elixir_cost=CARDS[card]['elixir'],reason=f"Defend ({threat:.0f}%)")
-                return self.recommendation
+                return create_recommendation(card=card,card_name=NAMES.get(card,card),position=pos,elixir_cost=CARDS[card]['elixir'],reason=f"Defend ({threat:.0f}%)")
 
         if elixir >= 7:
             for card in ['gia','kni']:
                 if card in self.hand and elixir >= CARDS[card]['elixir']:
-                    self.recommendation = create_recommendation(card=card,card_name=NAMES.get(card,card),position=self.get_position(card),elixir_cost=CARDS[card]['elixir'],reason='Start push')
-                    return self.recommendation
+                    return create_recommendation(card=card,card_name=NAMES.get(card,card),position=self.get_position(card),elixir_cost=CARDS[card]['elixir'],reason='Start push')
 
-        self.recommendation = create_recommendation(card=None,card_name='Wait',position=None,elixir_cost=0,reason=f'Save elixir ({elixir:.1f})')
-        return self.recommendation
+        return create_recommendation(card=None,card_name='Wait',position=None,elixir_cost=0,reason=f'Save elixir ({elixir:.1f})')
 
     def on_card_played(self, card=None):
         if card: self.play_card(card)
@@ -210,4 +402,95 @@ class Predictor:
         for c in self.hand:
             hand_names.append(NAMES.get(c, c))
 
-        return f"Hand: {', '.join(hand_names)}\nNext: {NAMES.get(self.next_card,'?')}"
\ No newline at end of file
+        text = f"Hand: {', '.join(hand_names)}\nNext: {NAMES.get(self.next_card,'?')}"
+        if self.enemy_cycle.seen:
+            known = []
+            for c in self.enemy_cycle.hand:
+                known.append(NAMES.get(c, c))
+            known += ['?'] * self.enemy_cycle.unknown
+            text += f"\nEnemy: {', '.join(known)}"
+        return text
+
+TEAMS = ['blue', 'red']
+
+# Recommendations for many games at once, e.g. both sides of lots of matches.
+# games is a list of (arena, team, hand) and the result is a list of dicts shaped
+# just like get_recommendation's. Threat and the nearest enemy come from one set of
+# numpy arrays for every game (see _batch_threat), so the only per-game work left
+# is the decision itself. That runs on one reused predictor per team instead of a
+# new one for each game, and with an evaluator every game's counter candidates
+# are encoded and scored in a single batch.
+def get_recommendations(games, evaluator=None):
+    if not games: return []
+    scratch = {team: Predictor(None, team, evaluator) for team in TEAMS}
+    # Only the hand is needed for a decision, so the rest of the cycle is left alone
+    def bind(i):
+        arena, team, hand = games[i]
+        p = scratch[team]
+        p.arena, p.cycle.hand = arena, list(hand[:4])
+        return p
+    if np is None: return [bind(i).get_recommendation(force=True) for i in range(len(games))]
+
+    threats, nearest = _batch_threat(games)
+    # Only games that are going to defend need a counter
+    defending = [i for i in range(len(games)) if games[i][2] and threats[i] > 50]
+    placements = {}
+    if evaluator:
+        jobs = []
+        for i in defending:
+            p = bind(i)
+            jobs.append((p.arena, p.team, p.hand, p.counter_candidates(nearest[i])))
+        for i, job, scores in zip(defending, jobs, evaluator.score_many(jobs)):
+            if job[3]: placements[i] = job[3][scores.index(max(scores))]
+    else:
+        for i in defending: placements[i] = bind(i).get_counter_placement(nearest[i])
+
+    results = []
+    for i in range(len(games)):
+        results.append(bind(i)._recommend(threats[i], lambda i=i: nearest[i], lambda e, i=i: placements.get(i, (None, None))))
+    return results
+
+# Threat and nearest enemy for every game at once. All the units of all the arenas
+# go into one flat array, each one is measured against the towers of the team it's
+# attacking, and bincount adds every unit's share onto that (arena, team). The sums
+# are added in the same order as get_threat's loop, so the numbers come out the same.
+def _batch_threat(games):
+    slot, arenas = {}, []
+    for arena, _, _ in games:
+        if id(arena) not in slot:
+            slot[id(arena)] = len(arenas)
+            arenas.append(arena)
+    units, counts = [], []
+    for arena in arenas:
+        units += arena.units
+        counts.append(len(arena.units))
+    # Towers never move, so their places come from the first arena and only
+    # whether they're still standing is read from each one
+    layout = np.array([(t.x, t.y) for team in TEAMS for t in arenas[0].towers[team].values()]).reshape(2, 3, 2)
+    alive = np.array([t.health > 0 for arena in arenas for team in TEAMS for t in arena.towers[team].values()])
+    # (arena, team) rows of 3 towers, dead ones infinitely far away
+    towers = np.where(alive.reshape(-1, 3, 1), np.tile(layout, (len(arenas), 1, 1)), np.inf)
+
+    # (arena, team being attacked) for every unit, as one number
+    group = np.repeat(np.arange(len(arenas)), counts) * 2 + np.array([u.team == 'blue' for u in units], dtype=int)
+    ux, uy = np.array([u.x for u in units], dtype=float), np.array([u.y for u in units], dtype=float)
+    dmg = np.array([u.damage for u in units], dtype=float)
+    tx, ty = towers[group, :, 0], towers[group, :, 1]
+    # float_power squares with pow() like Python's ** does, plain numpy ** can be a bit off from it
+    d = np.sqrt(np.float_power(ux[:, None] - tx, 2) + np.float_power(uy[:, None] - ty, 2))
+    share = dmg[:, None] * np.clip(12 - d, 0, None) / 12
+    totals = np.bincount(np.repeat(group, 3), weights=share.ravel(), minlength=2*len(arenas)).tolist()
+
+    # The first unit with the smallest distance in each group, the same one min() would pick
+    closest = {}
+    if len(units) and max(totals)/5 > 50:
+        order = np.lexsort((d.min(axis=1), group))
+        first = np.flatnonzero(np.diff(group[order], prepend=-1))
+        closest = dict(zip(group[order][first].tolist(), order[first].tolist()))
+
+    threats, nearest = [], []
+    for arena, team, _ in games:
+        g = slot[id(arena)]*2 + (team == 'red')
+        threats.append(min(100, totals[g]/5))
+        nearest.append(units[closest[g]] if g in closest else None)
+    return threats, nearest
@@ -0,0 +1,82 @@
+# Made by Michael Hodis and Jonah Shatkin
+# Keeps the GUI loop inside a frame budget. The simulation always moves in fixed
+# 1/60 second ticks based on how much real time has passed, so a slow frame runs a
+# couple of ticks to catch up instead of slowing the match down. When frames keep
+# going over budget, the work that's safe to skip gets done less often, in order:
+#   level 1 - predictor refreshes less often
+#   level 2 - unit labels and health bars are redrawn less often
+#   level 3 - whole frames are skipped (sim still ticks, only drawing is skipped)
+import time
+
+# Every how many frames each kind of work happens at each level
+PREDICTOR_EVERY = [1, 4, 8, 15]
+DETAILS_EVERY = [1, 1, 3, 6]
+DRAW_EVERY = [1, 1, 1, 2]
+
+# Most ticks run in one frame. If we fall further behind than this the rest is
+# dropped and the match runs slower than real time (shown as the sim ratio).
+MAX_CATCHUP = 5
+# How many frames in a row have to be over (or well under) budget before the level changes
+PATIENCE = 30
+# A frame is over budget when the time from one frame to the next is this much longer
+# than the budget. That time includes whatever tk does between frames, not just our work.
+SLOW_FRAME = 1.2
+# Smoothing for the averages, closer to 1 is smoother
+SMOOTH = 0.9
+
+class FrameScheduler:
+    def __init__(self, tick_rate=60, fps=60, clock=time.perf_counter):
+        self.tick_time, self.budget, self.clock = 1/tick_rate, 1/fps, clock
+        self.level, self.frame = 0, 0
+        self.behind, self.last = 0.0, None
+        self.over, self.under = 0, 0
+        # Averages shown on the canvas, and the average time from one frame to the next
+        self.cost, self.fps, self.sim_ratio = 0.0, float(fps), 1.0
+        self.interval = self.budget
+
+    # Start of a frame. Returns how many sim ticks to run (0 while paused).
+    def begin(self, running=True):
+        now = self.clock()
+        dt = 0.0 if self.last is None else now - self.last
+        self.last, self.start = now, now
+        self.frame += 1
+        if dt > 0:
+            self.fps = SMOOTH*self.fps + (1-SMOOTH)/dt
+            self.interval = SMOOTH*self.interval + (1-SMOOTH)*dt
+        if not running:
+            self.behind = 0.0
+            return 0
+        self.behind += dt
+        ticks = int(self.behind / self.tick_time)
+        if ticks > MAX_CATCHUP:
+            ticks, self.behind = MAX_CATCHUP, 0.0
+        else:
+            self.behind -= ticks * self.tick_time
+        if dt > 0: self.sim_ratio = SMOOTH*self.sim_ratio + (1-SMOOTH)*min(1.0, ticks*self.tick_time/dt)
+        return ticks
+
+    def due(self, every):
+        return self.frame % every[self.level] == 0
+
+    def predictor_due(self): return self.due(PREDICTOR_EVERY)
+    def details_due(self): return self.due(DETAILS_EVERY)
+    def draw_due(self): return self.due(DRAW_EVERY)
+
+    # End of a frame. Measures what it cost and moves the level up or down.
+    # It goes up when frames come in slower than the budget, or our own work alone
+    # nearly fills it, and only comes back down once both are well inside it.
+    # Returns how many ms to wait before the next frame.
+    def end(self):
+        cost = self.clock() - self.start
+        self.cost = SMOOTH*self.cost + (1-SMOOTH)*cost
+        slow = self.interval > SLOW_FRAME*self.budget
+        self.over = self.over + 1 if slow or self.cost > 0.9*self.budget else 0
+        self.under = self.under + 1 if not slow and self.cost < 0.5*self.budget else 0
+        if self.over >= PATIENCE and self.level < len(PREDICTOR_EVERY)-1:
+            self.level, self.over = self.level + 1, 0
+        elif self.under >= PATIENCE and self.level > 0:
+            self.level, self.under = self.level - 1, 0
+        return max(1, int((self.budget - cost) * 1000))
+
+    def status(self):
+        return f"{self.fps:.0f} fps | sim {self.sim_ratio:.2f}x" + (f" | L{self.level}" if self.level else "")
@@ -0,0 +1,185 @@
+# Made by Michael Hodis and Jonah Shatkin
+# Makes training data for a learned evaluator by having two predictors play each
+# other with no GUI. Every decision gets saved as (state, action, outcome), where the
+# outcome (+1 win, 0 draw, -1 loss) is filled in once the match is over.
+#
+# Samples are written in blocks of fixed size records that are each zlib compressed.
+# Matches are split into jobs of matches_per_shard and each job writes its own shard
+# file (so one worker process can end up writing several). manifest.json lists where
+# each block starts so a reader can mmap a shard and only unpack the blocks it needs.
+#
+# Usage: python selfplay.py <out_dir> <matches> [workers]
+import contextlib, io, json, mmap, multiprocessing, os, random, sys, zlib
+import numpy as np
+from arena_new import Arena, TICK_RATE
+from predictor import Predictor, CARDS
+from features import CARD_KEYS, CARD_INDEX, POSITION_KEYS, POSITION_INDEX, FEATURE_SIZE, encode_state
+
+# Features are stored as float16 to halve the size, they're all small fractions anyway
+RECORD = np.dtype([('features', np.float16, (FEATURE_SIZE,)), ('card', np.int8), ('position', np.int8),
+                   ('outcome', np.int8), ('team', np.int8)])
+BLOCK_RECORDS = 1024
+MANIFEST_VERSION = 1
+
+# Both predictors get asked for a move twice a second
+DECISION_TICKS = 30
+# Chance of playing a random card instead, so the data isn't all the same few lines
+EXPLORE = 0.2
+# Waiting happens almost every decision, so only some of those are kept
+KEEP_WAIT = 0.1
+
+def king_down(arena):
+    return any(towers['king'].health <= 0 for towers in arena.towers.values())
+
+# Whoever took the king tower, otherwise whoever took more towers, None for a draw
+def winner(arena):
+    for team, enemy in [('blue', 'red'), ('red', 'blue')]:
+        if arena.towers[enemy]['king'].health <= 0: return team
+    crowns = {}
+    for team, enemy in [('blue', 'red'), ('red', 'blue')]:
+        crowns[team] = sum(1 for t in arena.towers[enemy].values() if t.health <= 0)
+    if crowns['blue'] == crowns['red']: return None
+    return 'blue' if crowns['blue'] > crowns['red'] else 'red'
+
+# One headless match. Returns a numpy array of RECORD with the outcomes filled in.
+def play_match(rng):
+    arena = Arena()
+    arena.verbose, arena.running = False, True
+    players = {}
+    for team in ['blue', 'red']:
+        players[team] = Predictor(arena, team)
+        players[team].set_deck(rng.sample(CARD_KEYS, min(8, len(CARD_KEYS))))
+
+    samples = []
+    end = int(arena.match_duration * TICK_RATE)
+    while arena.tick < end and not king_down(arena):
+        if arena.tick % DECISION_TICKS == 0:
+            for team, p in players.items():
+                rec = p.get_recommendation(force=True)
+                card, pos = rec['card'], rec['position']
+                if rng.random() < EXPLORE:
+                    affordable = [c for c in p.hand if CARDS[c]['elixir'] <= arena.elixir[team]]
+                    card = rng.choice(affordable) if affordable else None
+                    pos = rng.choice(POSITION_KEYS) if card else None
+                state = encode_state(arena, team, p.hand)
+                if card and arena.add_unit(card, pos, team):
+                    samples.append((state, CARD_INDEX[card], POSITION_INDEX[pos], team))
+                    p.play_card(card)
+                    players[p.enemy].on_enemy_played(card)
+                elif rng.random() < KEEP_WAIT:
+                    samples.append((state, -1, -1, team))
+        arena.update()
+
+    won = winner(arena)
+    records = np.zeros(len(samples), dtype=RECORD)
+    for i, (state, card, pos, team) in enumerate(samples):
+        records[i] = (state, card, pos, 0 if won is None else 1 if won == team else -1, 0 if team == 'blue' else 1)
+    return records
+
+# Writes records to one shard file in compressed blocks and remembers where each block is
+class ShardWriter:
+    def __init__(self, path):
+        self.path, self.file = path, open(path, 'wb')
+        self.pending, self.blocks, self.records = [], [], 0
+
+    def write(self, records):
+        self.pending.append(records)
+        if sum(len(r) for r in self.pending) >= BLOCK_RECORDS: self.flush(False)
+
+    def flush(self, final=True):
+        if not self.pending: return
+        data = np.concatenate(self.pending)
+        self.pending = []
+        # Only full blocks get written unless this is the end of the shard
+        full = len(data) if final else len(data) // BLOCK_RECORDS * BLOCK_RECORDS
+        for start in range(0, full, BLOCK_RECORDS):
+            block = data[start:min(full, start + BLOCK_RECORDS)]
+            packed = zlib.compress(block.tobytes(), 6)
+            self.blocks.append([self.file.tell(), len(packed), len(block)])
+            self.file.write(packed)
+            self.records += len(block)
+        if full < len(data): self.pending.append(data[full:])
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        return {'file': os.path.basename(self.path), 'records': self.records, 'blocks': self.blocks}
+
+# Runs inside a worker process. Prints from the arena/predictor are thrown away.
+def generate_shard(args):
+    out_dir, index, matches, seed = args
+    rng = random.Random(seed)
+    writer = ShardWriter(os.path.join(out_dir, f"shard-{index:05d}.bin"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(matches):
+            writer.write(play_match(rng))
+    return writer.close()
+
+# Splits the matches over the worker processes (one shard each per chunk of matches)
+# and writes the manifest once every shard is done
+def generate(out_dir, matches, workers=None, matches_per_shard=50, seed=0):
+    os.makedirs(out_dir, exist_ok=True)
+    jobs, index = [], 0
+    while index * matches_per_shard < matches:
+        n = min(matches_per_shard, matches - index * matches_per_shard)
+        jobs.append((out_dir, index, n, seed * 1000003 + index))
+        index += 1
+    with multiprocessing.Pool(workers) as pool:
+        shards = pool.map(generate_shard, jobs)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'feature_size': FEATURE_SIZE,
+        'dtype': [[name, RECORD.fields[name][0].base.str, list(RECORD.fields[name][0].shape)] for name in RECORD.names],
+        'cards': CARD_KEYS, 'positions': POSITION_KEYS,
+        'block_records': BLOCK_RECORDS,
+        'records': sum(s['records'] for s in shards),
+        'shards': shards,
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+# Streams batches out of a dataset without loading whole shards. Each shard is
+# memory mapped and blocks are unpacked one at a time as the batches need them.
+class DatasetReader:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.dtype = np.dtype([(name, np.dtype(base), tuple(shape)) for name, base, shape in self.manifest['dtype']])
+
+    def __len__(self):
+        return self.manifest['records']
+
+    def blocks(self, shuffle=False, seed=0):
+        order = [(s, b) for s in self.manifest['shards'] for b in s['blocks']]
+        if shuffle: random.Random(seed).shuffle(order)
+        maps = {}
+        try:
+            for shard, (offset, size, count) in order:
+                if shard['file'] not in maps:
+                    with open(os.path.join(self.directory, shard['file']), 'rb') as f:
+                        maps[shard['file']] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                raw = zlib.decompress(maps[shard['file']][offset:offset+size])
+                yield np.frombuffer(raw, dtype=self.dtype, count=count)
+        finally:
+            for m in maps.values(): m.close()
+
+    # Gives back record arrays of batch_size (the last one may be shorter)
+    def batches(self, batch_size, shuffle=False, seed=0):
+        rest = None
+        for block in self.blocks(shuffle, seed):
+            if rest is not None: block = np.concatenate([rest, block])
+            full = len(block) // batch_size * batch_size
+            for start in range(0, full, batch_size):
+                yield block[start:start+batch_size]
+            rest = block[full:] if full < len(block) else None
+        if rest is not None: yield rest
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python selfplay.py <out_dir> <matches> [workers]")
+        sys.exit(1)
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    m = generate(sys.argv[1], int(sys.argv[2]), workers)
+    print(f"Wrote {m['records']} samples in {len(m['shards'])} shards to {sys.argv[1]}")
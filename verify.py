@@ -0,0 +1,157 @@
+# Made by Michael Hodis and Jonah Shatkin
+# Checks that two simulation engines play out the exact same matches.
+# Any faster engine we try (vectorized, event based, ...) is only useful if its
+# results match the original Arena.update, so every scenario below gets run through
+# both engines side by side. Each tick the checksums are compared, and the first
+# time they disagree we look through the state to find which unit went wrong.
+#
+# An engine is anything with add_unit(key, pos, team), update() and state() like Arena.
+#
+# It also checks rewinding: a match is rewound with History part way through and
+# played again from there, and the replay has to give the same checksums.
+# And it checks that the background worker still defends when a push is on our tower.
+#
+# Usage: python verify.py [tolerance]
+import sys
+from arena_new import Arena
+from history import History
+from predictor import Predictor
+from worker import RecommendationWorker
+
+# Each scenario is a list of (tick, card, position, team) plays. They're timed so
+# every play can be afforded (5 elixir to start, one more every 168 ticks) and the
+# spells land on troops, so play() treats a rejected play as a broken scenario.
+SCENARIOS = {
+    'knight_duel': [(0, 'kni', 'bl', 'blue'), (0, 'kni', 'bl', 'red')],
+    'giant_push': [(0, 'gia', 'fl', 'blue'), (400, 'mpk', 'tl', 'red'), (680, 'mus', 'fl', 'blue')],
+    'swarm_vs_spell': [(0, 'gob', 'br', 'red'), (0, 'arr', 'br', 'blue'), (170, 'mns', 'or', 'blue')],
+    'pocket_push': [(0, 'gia', 'pl', 'red'), (200, 'kni', 'tl', 'blue'), (510, 'arc', 'pl', 'red'), (540, 'fir', 'bl', 'blue')],
+    'both_lanes': [(0, 'spe', 'bl', 'blue'), (0, 'spe', 'br', 'red'), (150, 'kni', 'bl', 'red'), (170, 'mpk', 'br', 'blue'),
+                   (840, 'gia', 'fr', 'red'), (850, 'mus', 'kl', 'blue')],
+}
+
+# Runs one scenario tick by tick, giving back how many ticks have run and the engine.
+# With start it picks up from an engine that is already at that tick.
+def play(engine, scenario, ticks, start=0):
+    plays = sorted(scenario, key=lambda p: p[0])
+    i = 0
+    while i < len(plays) and plays[i][0] < start: i += 1
+    for tick in range(start, ticks):
+        while i < len(plays) and plays[i][0] <= tick:
+            _, card, pos, team = plays[i]
+            if not engine.add_unit(card, pos, team):
+                raise ValueError(f"{card} at {pos} for {team} was rejected at tick {tick}")
+            i += 1
+        engine.update()
+        yield tick + 1, engine
+
+# Finds the first entity (and value) where two states are further apart than tolerance
+def first_difference(state_a, state_b, tolerance):
+    a, b = dict(state_a), dict(state_b)
+    for name, values in state_a:
+        if name not in b: return {'entity': name, 'field': None, 'a': values, 'b': 'missing'}
+        for i, (va, vb) in enumerate(zip(values, b[name])):
+            if abs(va - vb) > tolerance: return {'entity': name, 'field': i, 'a': va, 'b': vb}
+    for name, values in state_b:
+        if name not in a: return {'entity': name, 'field': None, 'a': 'missing', 'b': values}
+    return None
+
+# Runs the scenario through both engines and returns where they first split up, or None.
+# make_a and make_b build a fresh engine each time they are called.
+def compare_engines(make_a, make_b, scenario, ticks=1200, tolerance=1e-6):
+    a, b = make_a(), make_b()
+    for engine in [a, b]:
+        if hasattr(engine, 'verbose'): engine.verbose = False
+    for (tick, a), (_, b) in zip(play(a, scenario, ticks), play(b, scenario, ticks)):
+        # Checksums are cheap, only dig through the state when they don't match.
+        # Rounding can still put two close values on different sides, so the
+        # detailed check has the final say.
+        if a.checksum(tolerance) == b.checksum(tolerance): continue
+        diff = first_difference(a.state(), b.state(), tolerance)
+        if diff:
+            diff['tick'] = tick
+            return diff
+    return None
+
+# Runs every scenario and gives back {name: first difference or None}
+def run_corpus(make_a, make_b, scenarios=SCENARIOS, ticks=1200, tolerance=1e-6):
+    results = {}
+    for name, scenario in scenarios.items():
+        results[name] = compare_engines(make_a, make_b, scenario, ticks, tolerance)
+    return results
+
+# Plays the scenario with a History, rewinds `back` ticks from the end and plays
+# the rest again. Returns where the replay first split from the original, or None.
+def check_rewind(make, scenario, ticks=1200, back=600, tolerance=1e-6):
+    engine = make()
+    if hasattr(engine, 'verbose'): engine.verbose = False
+    history, sums, states = History(), {}, {}
+    for tick, e in play(engine, scenario, ticks):
+        history.record(e)
+        sums[tick], states[tick] = e.checksum(tolerance), e.state()
+    start = history.restore(engine, ticks - back)['tick']
+    # The restored state itself has to match, then every tick played after it
+    def differs(tick, e):
+        if e.checksum(tolerance) == sums[tick]: return None
+        diff = first_difference(states[tick], e.state(), tolerance)
+        if diff: diff['tick'] = tick
+        return diff
+    diff = differs(start, engine)
+    if diff: return diff
+    for tick, e in play(engine, scenario, ticks, start):
+        diff = differs(tick, e)
+        if diff: return diff
+    return None
+
+def run_rewinds(make, scenarios=SCENARIOS, ticks=1200, back=600, tolerance=1e-6):
+    results = {}
+    for name, scenario in scenarios.items():
+        results[name + ' (rewind)'] = check_rewind(make, scenario, ticks, back, tolerance)
+    return results
+
+# Hands to defend a Giant + Mini P.E.K.K.A. push with. The worker's rollouts used
+# to talk itself into waiting with each of these.
+DEFENCE_HANDS = [['mns', 'arc', 'arr', 'kni'], ['mns', 'gob', 'arr', 'spe'], ['mns', 'mpk', 'gob', 'gia']]
+
+# Lets the push hit our left tower for a while (it's at 100% threat from tick 170 on),
+# runs the worker's whole search on it and gives back {hand: reason} for every hand
+# that ended on Wait
+def check_defence(hands=DEFENCE_HANDS, ticks=500):
+    arena = Arena()
+    arena.verbose, arena.elixir['red'] = False, 10
+    arena.add_unit('gia', 'bl', 'red')
+    arena.add_unit('mpk', 'bl', 'red')
+    worker = RecommendationWorker()
+    worker.running = True
+    waited = {}
+    for _ in range(ticks): arena.update()
+    threat = Predictor(arena, 'blue').get_threat()
+    if threat < 100: return {'setup': f"threat is only {threat:.0f}%"}
+    for hand in hands:
+        p = Predictor(arena, 'blue')
+        p.hand = hand
+        worker.solve(worker.generation, p)
+        if not worker.latest['card']: waited[' '.join(hand)] = worker.latest['reason']
+    return waited
+
+def report(results):
+    bad = 0
+    for name, diff in results.items():
+        if diff is None:
+            print(f"{name}: OK")
+        else:
+            bad += 1
+            print(f"{name}: differs at tick {diff['tick']} on {diff['entity']} field {diff['field']} ({diff['a']} vs {diff['b']})")
+    return bad
+
+# Until there's a second engine this checks Arena against itself, which catches
+# anything that isn't deterministic (like the old floating point clock)
+if __name__ == "__main__":
+    tolerance = float(sys.argv[1]) if len(sys.argv) > 1 else 1e-6
+    bad = report(run_corpus(Arena, Arena, tolerance=tolerance))
+    bad += report(run_rewinds(Arena, tolerance=tolerance))
+    waited = check_defence()
+    for hand, reason in waited.items(): print(f"defence ({hand}): ended on Wait ({reason})")
+    if not waited: print("defence: OK")
+    bad += len(waited)
+    sys.exit(1 if bad else 0)
@@ -0,0 +1,167 @@
+# Made by Michael Hodis and Jonah Shatkin
+# Runs the predictor on a background thread so the tkinter loop never waits on it.
+# The GUI hands it a copy of the arena, and it first publishes the normal heuristic
+# answer, then keeps improving it by simulating each card it could play a few seconds
+# ahead. Whatever the best answer is so far gets published for the GUI to pick up.
+import queue, threading
+from predictor import CARDS, NAMES
+
+# How far ahead each candidate card gets simulated (in ticks, 60 per second).
+# Long enough for a push at our tower to land or be cleaned up.
+ROLLOUT_TICKS = 600
+# How often a rollout stops to check if it should be cancelled
+CHECK_EVERY = 30
+# What rollout gives back when the arena won't take the play, so only that card is skipped
+REJECTED = object()
+
+# Everything that would make an answer out of date if it changes.
+# Elixir is rounded down so it only counts once a whole elixir is gained.
+def state_signature(arena, predictor):
+    return (len(arena.units), len(arena.spells), tuple(predictor.hand), predictor.next_card,
+            tuple(predictor.enemy_cycle.hand), predictor.enemy_cycle.unknown,
+            int(arena.elixir[predictor.team]),
+            tuple(t.health > 0 for towers in arena.towers.values() for t in towers.values()))
+
+# Rough worth of one elixir in tower hp, so playing a card isn't free in a rollout
+ELIXIR_VALUE = 100
+# Troops still in range of a tower when the rollout ends haven't finished hitting it.
+# Each one counts for this many more hits, with the same 12 tile falloff as get_threat.
+PENDING_HITS = 5
+# A rollout has to beat a Defend answer by this much (about 3 elixir) to replace it
+DEFEND_MARGIN = 300
+
+# Damage one team's troops are still about to deal to the other team's standing towers
+def pending_damage(arena, team):
+    enemy = 'red' if team == 'blue' else 'blue'
+    towers = [t for t in arena.towers[enemy].values() if t.health > 0]
+    total = 0
+    for u in arena.units:
+        if u.team != team or not towers: continue
+        d = min(u.dist(t.x, t.y) for t in towers)
+        if d < 12: total += u.damage * (12-d) / 12 * PENDING_HITS
+    return total
+
+# Tower damage we deal minus tower damage we take (counting what's still coming),
+# plus a bit for the troops still alive and the elixir left over
+def score_arena(arena, team):
+    enemy = 'red' if team == 'blue' else 'blue'
+    score = (arena.elixir[team] - arena.elixir[enemy]) * ELIXIR_VALUE
+    for t in arena.towers[enemy].values(): score += t.max_health - max(0, t.health)
+    for t in arena.towers[team].values(): score -= t.max_health - max(0, t.health)
+    score += pending_damage(arena, team) - pending_damage(arena, enemy)
+    for u in arena.units:
+        score += u.health * 0.1 if u.team == team else -u.health * 0.1
+    return score
+
+class RecommendationWorker:
+    def __init__(self):
+        self.jobs = queue.Queue(maxsize=1)
+        # The latest answer. Replacing it is a single assignment so the GUI can
+        # read it at any time without a lock.
+        self.latest = None
+        self.generation, self.signature = 0, None
+        # Held while the generation changes and while an answer is checked and stored,
+        # so an answer for an old generation can't land after the generation moved on
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.lock: self.generation += 1
+        self.submit_job(None)
+
+    # Forget the current answer, e.g. after the match is rewound and it's about the future.
+    # The next submit always counts as a change.
+    def reset(self):
+        with self.lock:
+            self.generation += 1
+            self.signature, self.latest = None, None
+
+    # Drop whatever job is still waiting, only the newest state matters
+    def submit_job(self, job):
+        try: self.jobs.get_nowait()
+        except queue.Empty: pass
+        self.jobs.put(job)
+
+    # Called from the GUI thread with the live arena and predictor. They get copied here
+    # so the worker never touches anything the GUI is changing.
+    # Returns True if the state changed enough to cancel the current job.
+    def submit(self, arena, predictor, force=False):
+        sig = state_signature(arena, predictor)
+        changed = sig != self.signature
+        if changed:
+            self.signature = sig
+            with self.lock: self.generation += 1
+        elif not force:
+            return False
+        snap = arena.snapshot()
+        self.submit_job((self.generation, predictor.clone(snap)))
+        return changed
+
+    def cancelled(self, gen):
+        return not self.running or gen != self.generation
+
+    def run(self):
+        while self.running:
+            job = self.jobs.get()
+            if job is None: continue
+            gen, predictor = job
+            try: self.solve(gen, predictor)
+            except Exception as e: print(f"Predictor worker error: {e}")
+
+    def publish(self, gen, rec):
+        with self.lock:
+            if gen == self.generation: self.latest = rec
+
+    # Runs the arena copy forward with one card played (or nothing, if card is None).
+    # The opponent answers with their best reply out of the cards that could be in
+    # their hand. That's just the known cards once the cycle is worked out, and any
+    # card we haven't seen them play before that.
+    # Returns None if cancelled partway through, or REJECTED if the card couldn't be played.
+    def rollout(self, gen, predictor, card, pos):
+        arena = predictor.arena.snapshot()
+        if card and not arena.add_unit(card, pos, predictor.team): return REJECTED
+        reply = predictor.opponent(arena).get_recommendation(force=True)
+        if reply['card']: arena.add_unit(reply['card'], reply['position'], predictor.enemy)
+        for i in range(ROLLOUT_TICKS):
+            if i % CHECK_EVERY == 0 and self.cancelled(gen): return None
+            arena.update()
+        return score_arena(arena, predictor.team)
+
+    # Anytime search: the heuristic answer goes out right away, then waiting and each
+    # playable card are simulated and the answer only changes if one does strictly better.
+    # A Defend answer needs to be beaten by DEFEND_MARGIN, since a rollout can still
+    # undervalue a defence.
+    def solve(self, gen, predictor):
+        base = predictor.get_recommendation(force=True)
+        self.publish(gen, base)
+        if not predictor.hand: return
+
+        best_score = self.rollout(gen, predictor, base['card'], base['position'])
+        if best_score is None: return
+        if best_score is REJECTED: best_score = float('-inf')
+        elif base['card'] and base['reason'].startswith('Defend'): best_score += DEFEND_MARGIN
+        elixir = predictor.arena.elixir[predictor.team]
+        for card in [None] + predictor.hand:
+            if card == base['card']: continue
+            cost = CARDS.get(card,{}).get('elixir',10) if card else 0
+            if isinstance(cost,str) or cost > elixir: continue
+            pos = predictor.get_position(card, base['threat_level'] > 50) if card else None
+            score = self.rollout(gen, predictor, card, pos)
+            if score is None: return
+            if score is REJECTED: continue
+            if score > best_score:
+                best_score = score
+                rec = dict(base)
+                if card:
+                    rec.update(card=card, card_name=NAMES.get(card,card), position=pos, elixir_cost=cost,
+                               reason=f"Best in {ROLLOUT_TICKS//60}s sim")
+                else:
+                    rec.update(card=None, card_name='Wait', position=None, elixir_cost=0,
+                               reason=f"Save elixir ({elixir:.1f})")
+                self.publish(gen, rec)